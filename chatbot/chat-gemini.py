@@ -1,15 +1,22 @@
 import google.generativeai as genai
-from langchain.prompts import ChatPromptTemplate
-from langchain.memory import ConversationBufferWindowMemory
 from qdrant_client import QdrantClient
+from qdrant_client.models import QuantizationSearchParams, SearchParams
 import streamlit as st
+import numpy as np
 import os
+import re
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from string import Template
 from dotenv import load_dotenv
-from styles import get_custom_css, get_welcome_banner, get_footer, format_status_indicator
+from styles import get_custom_css, get_welcome_banner, get_footer, format_status_indicator, format_chat_history
 
 # Load environment variables
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 # Configure Gemini API
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 if not GEMINI_API_KEY or GEMINI_API_KEY == "your_gemini_api_key_here":
@@ -17,7 +24,27 @@ if not GEMINI_API_KEY or GEMINI_API_KEY == "your_gemini_api_key_here":
     st.info("Get your API key from: https://makersuite.google.com/app/apikey")
     st.stop()
 
-genai.configure(api_key=GEMINI_API_KEY)
+# gRPC keeps one HTTP/2 channel open, so successive calls reuse the connection
+genai.configure(
+    api_key=GEMINI_API_KEY,
+    transport=os.getenv("GEMINI_TRANSPORT", "grpc"),
+)
+
+# Gemini accepts at most 100 texts per batch embedding request
+GEMINI_BATCH_LIMIT = 100
+GEMINI_BATCH_WORKERS = 4
+
+# st.cache_data outlives reruns; a module-level lru_cache is rebuilt each time
+# Streamlit re-executes the script
+@st.cache_data(max_entries=512, show_spinner=False)
+def _embed_query_cached(model, text):
+    """Embed a query once per (model, text); repeated queries skip the API call"""
+    result = genai.embed_content(
+        model=model,
+        content=text,
+        task_type="retrieval_query"
+    )
+    return np.asarray(result['embedding'], dtype=np.float32)
 
 # Custom embedding class for Gemini
 class GeminiEmbeddings:
@@ -25,126 +52,223 @@ class GeminiEmbeddings:
         self.model = model
     
     def embed_documents(self, texts):
-        """Embed a list of documents"""
-        embeddings = []
-        for text in texts:
-            try:
-                result = genai.embed_content(
-                    model=self.model,
-                    content=text,
-                    task_type="retrieval_document"
-                )
-                embeddings.append(result['embedding'])
-            except Exception as e:
-                st.error(f"Error embedding document: {e}")
-                return None
-        return embeddings
-    
-    def embed_query(self, text):
-        """Embed a single query"""
-        try:
+        """Embed a list of documents, batched up to GEMINI_BATCH_LIMIT texts per request"""
+        texts = list(texts)
+        embeddings = [None] * len(texts)
+        offsets = range(0, len(texts), GEMINI_BATCH_LIMIT)
+
+        def embed_batch(start):
+            batch = texts[start:start + GEMINI_BATCH_LIMIT]
             result = genai.embed_content(
                 model=self.model,
-                content=text,
-                task_type="retrieval_query"
+                content=batch,
+                task_type="retrieval_document"
             )
-            return result['embedding']
+            return start, np.asarray(result['embedding'], dtype=np.float32)
+
+        try:
+            with ThreadPoolExecutor(max_workers=GEMINI_BATCH_WORKERS) as executor:
+                for start, batch_embeddings in executor.map(embed_batch, offsets):
+                    embeddings[start:start + len(batch_embeddings)] = list(batch_embeddings)
         except Exception as e:
-            st.error(f"Error embedding query: {e}")
+            st.error(f"Error embedding documents: {e}")
             return None
+        return embeddings
+
+# Token budget for the conversation history included in the prompt
+MAX_HISTORY_TOKENS = int(os.getenv("MAX_HISTORY_TOKENS", "2000"))
 
-# Initialize Gemini model for chat
+# Below this top retrieval score the question is answered without calling Gemini
+RELEVANCE_FLOOR = float(os.getenv("RELEVANCE_FLOOR", "0.4"))
+NO_ANSWER_MESSAGE = "I don't have enough information to answer that question."
+
+# Default Gemini model for chat
 ai_model = os.getenv("AI_MODEL", "gemini-pro")
-chat_model = genai.GenerativeModel(ai_model)
-
-# Chat prompt template
-prompt_template = ChatPromptTemplate.from_messages(
-    [
-        (
-            "system",
-            "You are a helpful assistant who helps in finding answers to questions using the provided context.",
-        ),
-        (
-            "human",
-            """
-        The answer should be based on the text context given in "text_context" and the conversation history given in "conversation_history".
-        Base your response on the provided text context and the current conversation history to answer the query.
-        Select the most relevant information from the context.
-        Generate a draft response using the selected information. Remove duplicate content from the draft response.
-        Generate your final response after adjusting it to increase accuracy and relevance.
-        Now only show your final response!
-        If you do not know the answer or context is not relevant, response with "I don't know".
-
-        text_context:
-        {context}
-
-        conversation_history:
-        {history}
-
-        query:
-        {query}
-        """,
-        ),
-    ]
-)
+
+# Chat prompt template, parsed once at import; $-placeholders are safe
+# against braces in retrieved context
+PROMPT_TEMPLATE = Template("""
+You are a helpful AI assistant. Use the provided context and conversation history to answer the user's question.
+
+INSTRUCTIONS:
+- Base your response primarily on the provided context
+- Reference the conversation history when relevant
+- If the context doesn't contain relevant information, say "I don't have enough information to answer that question."
+- Be concise but comprehensive
+- Use a friendly, professional tone
+
+CONTEXT:
+$context
+
+CONVERSATION HISTORY:
+$history
+
+USER QUESTION:
+$query
+
+RESPONSE:
+""")
+
+@st.cache_resource
+def get_embedder():
+    """Create the embedding model once per process instead of on every rerun"""
+    return GeminiEmbeddings()
+
+@st.cache_resource
+def get_qdrant_client():
+    """Create the Qdrant client once per process so reruns reuse its connection pool"""
+    return QdrantClient(
+        url=os.getenv("QDRANT_URL", "http://localhost:6333"),
+        api_key=os.getenv("APIKEY") if os.getenv("APIKEY") != "fkjabjkbsajkbasjkdbaksjbdkabdkjbadkjbadbauosdib" else None,
+        prefer_grpc=os.getenv("QDRANT_PREFER_GRPC", "false").lower() == "true",
+        grpc_port=int(os.getenv("QDRANT_GRPC_PORT", "6334")),
+        timeout=10,
+    )
 
 # Initialize embedding model
-embedding_model = GeminiEmbeddings()
+embedding_model = get_embedder()
 
 # Initialize Qdrant client
-client = QdrantClient(
-    url=os.getenv("QDRANT_URL", "http://localhost:6333"),
-    api_key=os.getenv("APIKEY") if os.getenv("APIKEY") != "fkjabjkbsajkbasjkdbaksjbdkabdkjbadkjbadbauosdib" else None,
-)
+client = get_qdrant_client()
 
 collection_name = os.getenv("COLLECTION_NAME", "chatbot-docs")
 
-# Function to search similar documents
-def similarity_search(query, k=4):
-    """Search for similar documents in Qdrant"""
-    try:
-        # Get query embedding
-        query_embedding = embedding_model.embed_query(query)
-        if query_embedding is None:
-            return []
-        
-        # Search in Qdrant
-        search_results = client.search(
-            collection_name=collection_name,
-            query_vector=query_embedding,
-            limit=k
-        )
-        
-        # Convert to documents format
-        docs = []
-        for result in search_results:
-            docs.append({
-                "page_content": result.payload.get("text", ""),
-                "metadata": result.payload.get("metadata", {}),
-                "score": result.score
-            })
-        
-        return docs
-    except Exception as e:
-        st.error(f"Error searching documents: {e}")
-        return []
+# Longer questions are truncated to stay within the embedding model's input limit
+MAX_QUERY_CHARS = 8000
+
+# Longer retrieved chunks are cut to this length in the prompt context
+MAX_DOC_CHARS = 4000
+
+# Length of the preview shown for each source document
+SOURCE_SNIPPET_CHARS = 300
+
+# Only the payload fields the UI reads are fetched from Qdrant
+SEARCH_PAYLOAD_FIELDS = ["text", "metadata"]
+# Search the int8-quantized vectors, then rescore an oversampled top-k on the
+# original float32 vectors to keep recall
+SEARCH_PARAMS = SearchParams(
+    hnsw_ef=64,
+    exact=False,
+    quantization=QuantizationSearchParams(ignore=False, rescore=True, oversampling=2.0)
+)
+
+def _to_docs(search_results):
+    """Convert Qdrant hits to the documents format used by the UI"""
+    return [
+        {
+            "page_content": result.payload.get("text", ""),
+            "metadata": result.payload.get("metadata", {}),
+            "score": result.score
+        }
+        for result in search_results
+    ]
+
+def search_by_vector(query_embedding, k=4):
+    """Search Qdrant with an already computed query embedding"""
+    return client.search(
+        collection_name=collection_name,
+        query_vector=query_embedding,
+        limit=k,
+        search_params=SEARCH_PARAMS,
+        with_payload=SEARCH_PAYLOAD_FIELDS
+    )
+
+def retrieve(query, k):
+    """Embed the query and return the k most similar documents from Qdrant"""
+    query_embedding = _embed_query_cached(embedding_model.model, query)
+    return _to_docs(search_by_vector(query_embedding, k))
+
+def get_chat_model(model_name):
+    """Return the session's GenerativeModel for model_name, creating it on first use"""
+    model_key = f"_model_{model_name}"
+    if model_key not in st.session_state:
+        st.session_state[model_key] = genai.GenerativeModel(model_name)
+    return st.session_state[model_key]
+
+@st.cache_data(max_entries=1024, show_spinner=False)
+def _count_tokens_cached(model_name, text):
+    """Count tokens once per (model, text), across reruns and sessions"""
+    return get_chat_model(model_name).count_tokens(text).total_tokens
+
+def _message_tokens(message, model_name):
+    """Token count for a message under model_name, stored on the message so it is only computed once per model"""
+    counts = message.setdefault("_tok", {})
+    if model_name not in counts:
+        try:
+            counts[model_name] = _count_tokens_cached(model_name, message["content"])
+        except Exception:
+            # Rough estimate if the count_tokens call fails
+            counts[model_name] = len(message["content"]) // 4 + 1
+    return counts[model_name]
+
+def format_history(messages, model_name, budget=MAX_HISTORY_TOKENS):
+    """Format the most recent messages that fit in the token budget, in chronological
+    order, excluding the current question"""
+    recent = []
+    used = 0
+    for m in reversed(messages[:-1]):
+        used += _message_tokens(m, model_name)
+        if used > budget:
+            break
+        recent.append(m)
+    return "\n".join(
+        f"{'User' if m['role'] == 'human' else 'Assistant'}: {m['content']}"
+        for m in reversed(recent)
+    )
 
 def format_docs(docs):
-    return "\n\n".join([d["page_content"] for d in docs])
+    """Join retrieved chunks into the prompt context, capping each at MAX_DOC_CHARS"""
+    return "\n\n".join(d["page_content"][:MAX_DOC_CHARS] for d in docs)
+
+# Characters that markdown (or Streamlit's $...$ LaTeX) would interpret in a snippet
+_MARKDOWN_SPECIAL = re.compile(r"([\\`*_{}\[\]()#+\-.!|>~<$])")
+
+def _plain_snippet(text):
+    """Collapse whitespace and escape markdown so a snippet renders as one plain paragraph"""
+    return _MARKDOWN_SPECIAL.sub(r"\\\1", " ".join(text.split()))
 
 def display_sources(docs):
     """Display source documents with scores"""
     if docs and len(docs) > 0:
         with st.expander(f"📄 Sources ({len(docs)} documents found)", expanded=False):
+            sources = []
             for i, doc in enumerate(docs, 1):
-                score_color = "🟢" if doc.get("score", 0) > 0.8 else "🟡" if doc.get("score", 0) > 0.6 else "🔴"
-                st.markdown(f"""
-                **Source {i}** {score_color} Relevance: {doc.get("score", 0):.2f}
-                
-                {doc["page_content"][:300]}{"..." if len(doc["page_content"]) > 300 else ""}
-                
-                ---
-                """)
+                score = doc.get("score", 0)
+                score_color = "🟢" if score > 0.8 else "🟡" if score > 0.6 else "🔴"
+                page_content = doc["page_content"]
+                snippet = _plain_snippet(page_content[:SOURCE_SNIPPET_CHARS])
+                suffix = "..." if len(page_content) > SOURCE_SNIPPET_CHARS else ""
+                sources.append(
+                    f"**Source {i}** {score_color} Relevance: {score:.2f}\n\n"
+                    f"{snippet}{suffix}\n\n"
+                    "---\n\n"
+                )
+            # One markdown element for all sources instead of one per source
+            st.markdown("".join(sources))
+
+def check_qdrant_connection():
+    """Probe the Qdrant connection"""
+    try:
+        client.get_collections()
+        return True
+    except Exception:
+        return False
+
+@st.cache_data(ttl=30, show_spinner=False)
+def check_gemini_api():
+    """Probe the Gemini API with a metadata-only model listing, cached between reruns"""
+    try:
+        next(iter(genai.list_models()), None)
+        return True
+    except Exception:
+        return False
+
+async def _check_services():
+    """Probe Qdrant and Gemini concurrently so neither check waits on the other"""
+    return await asyncio.gather(
+        asyncio.to_thread(check_qdrant_connection),
+        asyncio.to_thread(check_gemini_api)
+    )
 
 # Streamlit UI Configuration
 st.set_page_config(
@@ -162,28 +286,21 @@ with st.sidebar:
     st.markdown("### ⚙️ Configuration")
     
     # Connection Status
-    try:
-        # Test Qdrant connection
-        collections = client.get_collections()
+    qdrant_ok, gemini_ok = asyncio.run(_check_services())
+    if qdrant_ok:
         qdrant_status = "🟢 Connected"
         qdrant_color = "status-online"
-    except:
+    else:
         qdrant_status = "🔴 Disconnected"
         qdrant_color = "status-offline"
     
     st.markdown(format_status_indicator(qdrant_status, "Qdrant Database", qdrant_color), unsafe_allow_html=True)
     
     # API Status
-    try:
-        # Test Gemini API
-        test_response = genai.embed_content(
-            model="models/text-embedding-004",
-            content="test",
-            task_type="retrieval_query"
-        )
+    if gemini_ok:
         api_status = "🟢 Connected"
         api_color = "status-online"
-    except:
+    else:
         api_status = "🔴 API Key Invalid"
         api_color = "status-offline"
     
@@ -194,16 +311,20 @@ with st.sidebar:
     # Chat Settings
     st.markdown("### 🎛️ Chat Settings")
     
-    # Model selection
-    model_options = ["gemini-2.5-pro", "gemini-1.5-pro", "gemini-1.5-flash"]
-    current_model = os.getenv("AI_MODEL", "gemini-pro")
-    selected_model = st.selectbox("AI Model", model_options, index=model_options.index(current_model) if current_model in model_options else 0)
+    # Settings only apply on submit, so dragging a slider doesn't rerun the app
+    with st.form("settings"):
+        # Model selection
+        model_options = ["gemini-2.5-pro", "gemini-1.5-pro", "gemini-1.5-flash"]
+        current_model = os.getenv("AI_MODEL", "gemini-pro")
+        selected_model = st.selectbox("AI Model", model_options, index=model_options.index(current_model) if current_model in model_options else 0)
+    
+        # Search results count
+        search_limit = st.slider("Search Results", min_value=1, max_value=10, value=4, help="Number of relevant documents to retrieve")
     
-    # Search results count
-    search_limit = st.slider("Search Results", min_value=1, max_value=10, value=4, help="Number of relevant documents to retrieve")
+        # Temperature (if we want to add it later)
+        temperature = st.slider("Response Creativity", min_value=0.0, max_value=1.0, value=0.7, step=0.1, help="Higher values make responses more creative")
     
-    # Temperature (if we want to add it later)
-    temperature = st.slider("Response Creativity", min_value=0.0, max_value=1.0, value=0.7, step=0.1, help="Higher values make responses more creative")
+        st.form_submit_button("Apply", use_container_width=True)
     
     st.markdown("---")
     
@@ -220,7 +341,6 @@ with st.sidebar:
     # Clear chat button
     if st.button("🗑️ Clear Chat", type="secondary", use_container_width=True):
         st.session_state["messages"] = [{"role": "ai", "content": os.getenv("APP_CONTENT", "Welcome to the AI Chatbot! How can I help you?")}]
-        st.session_state["memory"].clear()
         st.rerun()
     
     st.markdown("---")
@@ -260,30 +380,20 @@ if "messages" not in st.session_state:
     app_content = os.getenv("APP_CONTENT", "Welcome to the AI Chatbot! How can I help you?")
     st.session_state["messages"] = [{"role": "ai", "content": app_content}]
 
-# Initialize conversation memory
-if "memory" not in st.session_state:
-    st.session_state["memory"] = ConversationBufferWindowMemory(
-        memory_key="history",
-        ai_prefix="Assistant",
-        human_prefix="User",
-        k=3,
-    )
-
 # Chat container
 chat_container = st.container()
 
 with chat_container:
-    # Display chat history with enhanced styling
-    for i, message in enumerate(st.session_state.messages):
-        if message["role"] == "ai":
-            with st.chat_message("assistant", avatar="🤖"):
-                st.markdown(message["content"])
-        else:
-            with st.chat_message("user", avatar="👤"):
-                st.markdown(message["content"])
+    # Display chat history as a single HTML element; only the new turn
+    # below uses chat_message widgets
+    st.markdown(format_chat_history(st.session_state.messages), unsafe_allow_html=True)
 
 # Chat input
-if chat_input := st.chat_input("💬 Ask me anything about your documents..."):
+chat_input = st.chat_input("💬 Ask me anything about your documents...")
+# Drop blank input and cap very long input before any API call
+if chat_input:
+    chat_input = chat_input.strip()[:MAX_QUERY_CHARS]
+if chat_input:
     # Add user message to chat
     with st.chat_message("user", avatar="👤"):
         st.markdown(chat_input)
@@ -291,80 +401,64 @@ if chat_input := st.chat_input("💬 Ask me anything about your documents..."):
 
     # Search for relevant documents
     with st.spinner("🔍 Searching knowledge base..."):
-        found_docs = similarity_search(chat_input, k=search_limit)
+        try:
+            found_docs = retrieve(chat_input, search_limit)
+        except Exception as e:
+            st.error(f"Error searching documents: {e}")
+            found_docs = []
         context = format_docs(found_docs)
 
-    # Prepare the prompt
-    history = st.session_state.memory.load_memory_variables({}).get("history", "")
+    # Skip the Gemini call when nothing relevant was retrieved
+    top_score = max((doc.get("score", 0) for doc in found_docs), default=0)
+    if top_score < RELEVANCE_FLOOR:
+        logger.info("Skipping generation: top relevance %.2f is below %s", top_score, RELEVANCE_FLOOR)
+        content = NO_ANSWER_MESSAGE
+        with st.chat_message("assistant", avatar="🤖"):
+            st.markdown(content)
+            display_sources(found_docs)
+        st.session_state.messages.append({"role": "ai", "content": content})
+    else:
+        # Prepare the prompt
+        history = format_history(st.session_state.messages, selected_model)
     
-    prompt_text = f"""
-    You are a helpful AI assistant. Use the provided context and conversation history to answer the user's question.
-    
-    INSTRUCTIONS:
-    - Base your response primarily on the provided context
-    - Reference the conversation history when relevant
-    - If the context doesn't contain relevant information, say "I don't have enough information to answer that question."
-    - Be concise but comprehensive
-    - Use a friendly, professional tone
-    
-    CONTEXT:
-    {context}
-    
-    CONVERSATION HISTORY:
-    {history}
-    
-    USER QUESTION:
-    {chat_input}
-    
-    RESPONSE:
-    """
-
-    # Generate response
-    with st.chat_message("assistant", avatar="🤖"):
-        with st.spinner("🤔 Thinking..."):
-            try:
-                # Update model if changed in sidebar
-                current_chat_model = genai.GenerativeModel(selected_model)
-                
-                response = current_chat_model.generate_content(prompt_text)
-                content = response.text
-                
-                # Display response with typing effect simulation
-                response_placeholder = st.empty()
-                displayed_text = ""
+        prompt_text = PROMPT_TEMPLATE.substitute(context=context, history=history, query=chat_input)
+
+        # Generate response
+        with st.chat_message("assistant", avatar="🤖"):
+            with st.spinner("🤔 Thinking..."):
+                try:
+                    # Reuse the model for the sidebar selection across turns
+                    current_chat_model = get_chat_model(selected_model)
                 
-                # Simulate typing effect (optional, remove if too slow)
-                import time
-                words = content.split()
-                for i, word in enumerate(words):
-                    displayed_text += word + " "
-                    if i % 5 == 0:  # Update every 5 words
-                        response_placeholder.markdown(displayed_text)
-                        time.sleep(0.1)
+                    response_stream = current_chat_model.generate_content(prompt_text, stream=True)
                 
-                response_placeholder.markdown(content)
-                st.session_state.messages.append({"role": "ai", "content": content})
+                    # Render the response as Gemini streams it back
+                    response_placeholder = st.empty()
+                    content = ""
+                    for chunk in response_stream:
+                        if chunk.text:
+                            content += chunk.text
+                            response_placeholder.markdown(content)
                 
-                # Display sources
-                display_sources(found_docs)
+                    st.session_state.messages.append({"role": "ai", "content": content})
                 
-                # Save to memory
-                st.session_state.memory.save_context({"input": chat_input}, {"output": content})
+                    # Display sources
+                    display_sources(found_docs)
                 
-                # Success metrics
-                if found_docs:
-                    avg_score = sum(doc.get("score", 0) for doc in found_docs) / len(found_docs)
-                    if avg_score > 0.7:
-                        st.success(f"✅ High confidence response (relevance: {avg_score:.2f})")
-                    elif avg_score > 0.5:
-                        st.info(f"ℹ️ Moderate confidence response (relevance: {avg_score:.2f})")
-                    else:
-                        st.warning(f"⚠️ Low confidence response (relevance: {avg_score:.2f})")
+                    # Success metrics
+                    if found_docs:
+                        avg_score = sum(doc.get("score", 0) for doc in found_docs) / len(found_docs)
+                        if avg_score > 0.7:
+                            st.success(f"✅ High confidence response (relevance: {avg_score:.2f})")
+                        elif avg_score > 0.5:
+                            st.info(f"ℹ️ Moderate confidence response (relevance: {avg_score:.2f})")
+                        else:
+                            st.warning(f"⚠️ Low confidence response (relevance: {avg_score:.2f})")
                 
-            except Exception as e:
-                error_msg = f"❌ Sorry, I encountered an error: {str(e)}"
-                st.error(error_msg)
-                st.session_state.messages.append({"role": "ai", "content": error_msg})
+                except Exception as e:
+                    error_msg = f"❌ Sorry, I encountered an error: {str(e)}"
+                    st.error(error_msg)
+                    st.session_state.messages.append({"role": "ai", "content": error_msg})
 
 # Footer
 st.markdown(get_footer(), unsafe_allow_html=True)
@@ -5,14 +5,14 @@ This module contains all the custom CSS styles used in the Streamlit chatbot int
 Separated from the main chat file for better organization and maintainability.
 """
 
-def get_custom_css():
-    """
-    Returns the custom CSS styles for the Streamlit chatbot interface.
-    
-    Returns:
-        str: CSS styles as a string
-    """
-    return """
+import html
+import re
+from functools import lru_cache
+
+import markdown
+from markdown.treeprocessors import Treeprocessor
+
+_CUSTOM_CSS = """
     <style>
         .main-header {
             font-size: 3rem;
@@ -95,6 +95,12 @@ def get_custom_css():
             margin-right: 2rem;
         }
         
+        .chat-avatar {
+            float: left;
+            font-size: 1.25rem;
+            margin-right: 0.75rem;
+        }
+        
         /* Source documents styling */
         .source-document {
             background-color: #f8f9fa;
@@ -232,6 +238,41 @@ def get_custom_css():
     </style>
     """
 
+def _minify_css(css):
+    """
+    Collapses comments and whitespace in a CSS block.
+    
+    Args:
+        css (str): CSS source, optionally wrapped in <style> tags
+    
+    Returns:
+        str: Minified CSS string
+    """
+    css = re.sub(r"/\*.*?\*/", "", css, flags=re.DOTALL)
+    css = re.sub(r"\s+", " ", css)
+    css = re.sub(r"\s*([{}:;,>])\s*", r"\1", css)
+    return css.strip()
+
+# Minified once at import so reruns reuse the same string
+_MINIFIED_CSS = _minify_css(_CUSTOM_CSS)
+
+_FOOTER_HTML = """
+    <div class="footer">
+        <p>🤖 Powered by Google Gemini API & Qdrant Vector Database</p>
+        <p>💡 <strong>Tip:</strong> Ask specific questions for better results</p>
+    </div>
+    """
+
+def get_custom_css():
+    """
+    Returns the custom CSS styles for the Streamlit chatbot interface.
+    
+    Returns:
+        str: Minified CSS styles as a string
+    """
+    return _MINIFIED_CSS
+
+@lru_cache(maxsize=8)
 def get_welcome_banner(title="🤖 AI Chatbot with Vector Search"):
     """
     Returns the HTML for the welcome banner with customizable title.
@@ -260,13 +301,9 @@ def get_footer():
     Returns:
         str: HTML string for the footer
     """
-    return """
-    <div class="footer">
-        <p>🤖 Powered by Google Gemini API & Qdrant Vector Database</p>
-        <p>💡 <strong>Tip:</strong> Ask specific questions for better results</p>
-    </div>
-    """
+    return _FOOTER_HTML
 
+@lru_cache(maxsize=32)
 def format_status_indicator(status_text, service_name, color_class):
     """
     Returns HTML for a status indicator.
@@ -288,6 +325,19 @@ def format_relevance_score(score):
     Args:
         score (float): Relevance score between 0 and 1
     
+    Returns:
+        str: HTML string for the score badge
+    """
+    return _relevance_score_html(round(score, 2))
+
+@lru_cache(maxsize=128)
+def _relevance_score_html(score):
+    """
+    Builds the score badge HTML for a score already rounded to 2 decimals.
+    
+    Args:
+        score (float): Rounded relevance score
+    
     Returns:
         str: HTML string for the score badge
     """
@@ -302,3 +352,82 @@ def format_relevance_score(score):
         emoji = "🔴"
     
     return f'<span class="relevance-score {score_class}">{emoji} {score:.2f}</span>'
+
+_SAFE_URL_SCHEMES = {"http", "https", "mailto"}
+# Browsers ignore whitespace and control characters inside a URL scheme
+_URL_IGNORED_CHARS = re.compile(r"[\x00-\x20\x7f]+")
+
+def _is_safe_url(url):
+    """
+    Checks a link or image URL against the allowed schemes.
+    
+    Args:
+        url (str): Attribute value as written in the HTML output
+    
+    Returns:
+        bool: True for http, https, mailto and relative URLs
+    """
+    url = _URL_IGNORED_CHARS.sub("", html.unescape(url))
+    scheme, has_scheme, _ = url.partition(":")
+    # A colon after "/", "?" or "#" belongs to a relative path, query or fragment
+    if not has_scheme or any(c in scheme for c in "/?#"):
+        return True
+    return scheme.lower() in _SAFE_URL_SCHEMES
+
+class _SafeLinks(Treeprocessor):
+    """Drops link and image URLs whose scheme is not allowed"""
+    def run(self, root):
+        for element in root.iter():
+            for attr in ("href", "src"):
+                if attr in element.attrib and not _is_safe_url(element.get(attr)):
+                    del element.attrib[attr]
+
+def _markdown_to_html(content):
+    """
+    Converts message markdown to HTML without passing raw HTML through.
+    
+    Args:
+        content (str): Message text in markdown
+    
+    Returns:
+        str: HTML string; raw HTML in the message is shown as text
+    """
+    # Markdown instances are not thread-safe, and Streamlit sessions share this module
+    md = markdown.Markdown(extensions=["fenced_code"])
+    md.preprocessors.deregister("html_block")
+    md.inlinePatterns.deregister("html")
+    md.treeprocessors.register(_SafeLinks(md), "safe_links", 0)
+    return md.convert(content)
+
+@lru_cache(maxsize=256)
+def format_chat_message(role, content):
+    """
+    Returns HTML for a single chat history message.
+    
+    Args:
+        role (str): Message role ("human" or "ai")
+        content (str): Message text in markdown
+    
+    Returns:
+        str: HTML string for the message
+    """
+    if role == "human":
+        role_class, avatar = "user-message", "👤"
+    else:
+        role_class, avatar = "assistant-message", "🤖"
+    # Streamlit reads this string as markdown again, and a blank line (e.g. in a
+    # code block) would end the HTML block, so keep it on one line
+    body = _markdown_to_html(content).replace("\n", "&#10;")
+    return f'<div class="chat-message {role_class}"><span class="chat-avatar">{avatar}</span>{body}</div>'
+
+def format_chat_history(messages):
+    """
+    Returns HTML for the whole chat history so it renders as one element.
+    
+    Args:
+        messages (list): Message dicts with "role" and "content" keys
+    
+    Returns:
+        str: HTML string for the chat history
+    """
+    return "".join(format_chat_message(m["role"], m["content"]) for m in messages)
@@ -0,0 +1,39 @@
+"""Tests for the chat history HTML built in styles.py"""
+
+import pytest
+
+from styles import format_chat_message
+
+
+@pytest.mark.parametrize("url", [
+    "javascript:alert(1)",
+    "JaVaScRiPt:alert(1)",
+    "java&#115;cript:alert(1)",
+    "&#106;avascript:alert(1)",
+    "&#x6A;avascript:alert(1)",
+    "jav&#x09;ascript:alert(1)",
+    "VBScript:msgbox(1)",
+    "data:text/html;base64,PHNjcmlwdD4=",
+])
+def test_unsafe_link_urls_are_dropped(url):
+    html = format_chat_message("ai", f"[x]({url}) ![i]({url})")
+    assert "href" not in html
+    assert "src" not in html
+
+
+@pytest.mark.parametrize("url", [
+    "https://example.com/a?b=c:d",
+    "HTTP://example.com",
+    "mailto:someone@example.com",
+    "/docs/faq.md",
+    "faq.md#section:one",
+])
+def test_allowed_link_urls_are_kept(url):
+    html = format_chat_message("ai", f"[x]({url})")
+    assert "href=" in html
+
+
+def test_raw_html_is_shown_as_text():
+    html = format_chat_message("human", "<script>alert(1)</script>")
+    assert "<script>" not in html
+    assert "&lt;script&gt;" in html
@@ -1,5 +1,7 @@
 import google.generativeai as genai
 import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -8,24 +10,44 @@ load_dotenv()
 # Test Gemini API key
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 
+def _one(text):
+    """Embed a single probe sentence"""
+    return genai.embed_content(
+        model="models/text-embedding-004",
+        content=text,
+        task_type="retrieval_document"
+    )
+
+def probe(n=1):
+    """Run n embedding probes in parallel; they share the client's gRPC channel"""
+    with ThreadPoolExecutor(max_workers=n) as executor:
+        return list(executor.map(_one, ["This is a test sentence."] * n))
+
+# Optional probe count, e.g. `python test-gemini-api.py 8`
+try:
+    probe_count = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+except ValueError:
+    probe_count = 0
+if probe_count < 1:
+    print(f"Usage: {sys.argv[0]} [probe_count >= 1]")
+    sys.exit(2)
+
 if not GEMINI_API_KEY or GEMINI_API_KEY == "your_gemini_api_key_here":
     print("❌ Please set your GEMINI_API_KEY in the .env file")
     print("   Get your API key from: https://makersuite.google.com/app/apikey")
 else:
     try:
-        genai.configure(api_key=GEMINI_API_KEY)
-        
-        # Test embedding
-        result = genai.embed_content(
-            model="models/text-embedding-004",
-            content="This is a test sentence.",
-            task_type="retrieval_document"
-        )
-        
+        # gRPC keeps one HTTP/2 connection open for every probe
+        genai.configure(api_key=GEMINI_API_KEY, transport="grpc")
+
+        # Test embedding (pass a count to run several probes at once)
+        results = probe(probe_count)
+
         print("✅ Gemini API key is working!")
-        print(f"   Embedding dimension: {len(result['embedding'])}")
+        print(f"   Probes succeeded: {len(results)}")
+        print(f"   Embedding dimension: {len(results[0]['embedding'])}")
         print("   Ready to run the training script!")
-        
+
     except Exception as e:
         print(f"❌ Error with Gemini API: {e}")
         print("   Please check your API key and internet connection")
@@ -67,6 +67,7 @@ def check_dependencies():
         'qdrant_client', 
         'langchain',
         'langchain_community',
+        'semantic_text_splitter',
         'pika',
         'dotenv'
     ]